@@ -2,16 +2,33 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import threading
 
 Base = declarative_base()
 engine = None
 SessionLocal = None
+# most connections the pool hands out at once (pool_size + max_overflow)
+pool_capacity = None
+_init_lock = threading.Lock()
 
 def init_db(database_url: str):
-    global engine, SessionLocal
-    if engine is None:
-        engine = create_engine(database_url)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        # create tables
-        from app import models
-        Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    global engine, SessionLocal, pool_capacity
+    # startup and the consumer thread both call this
+    with _init_lock:
+        if engine is None:
+            pool_size = int(os.getenv("DB_POOL_SIZE", "20"))
+            max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+            pool_capacity = pool_size + max_overflow
+            engine = create_engine(
+                database_url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=30,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+                future=True,
+            )
+            SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+            # create tables
+            from app import models
+            Base.metadata.create_all(bind=engine)
\ No newline at end of file
@@ -1,56 +1,168 @@
 import pika
-import json
+import orjson
+import functools
+import random
 import threading
 import time
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from app import models, database
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
 EXCHANGE = "ums_events"
+# published by POST /payments, persisted and processed by the consumer
+PAYMENT_REQUEST_KEY = "payment.commands.request"
+# unacked deliveries the broker may push to the consumer
+PAYMENT_PREFETCH = int(os.getenv("PAYMENT_PREFETCH", "100"))
+# deliveries per insert/ack batch; kept below the prefetch so the broker never stalls on a full window
+PAYMENT_ACK_BATCH = int(os.getenv("PAYMENT_ACK_BATCH", str(max(1, PAYMENT_PREFETCH // 2))))
+# upper bound (seconds) for the consumer's reconnect backoff
+MAX_RECONNECT_INTERVAL = float(os.getenv("MAX_RECONNECT_INTERVAL", "30"))
+# dev-only simulated gateway round-trip (seconds); 0 disables it
+SIM_GATEWAY_LATENCY = float(os.getenv("SIM_GATEWAY_LATENCY", "0"))
+# seconds between flushes of batched consumer acks
+ACK_FLUSH_INTERVAL = 0.25
+# seconds after which a PROCESSING claim counts as abandoned (its worker died) and may be
+# taken over; keep it well above the gateway's worst-case round-trip
+PAYMENT_CLAIM_TIMEOUT = float(os.getenv("PAYMENT_CLAIM_TIMEOUT", "300"))
 
-def publish_event(rabbitmq_url: str, routing_key: str, event: dict):
+# Every published event is a status change/command: persisted and publisher-confirmed.
+_PERSISTENT = pika.BasicProperties(delivery_mode=2, content_type="application/json")
+
+# Heartbeats for the consumer connection, which start_consuming services. Nothing runs
+# the publisher's event loop between publishes, so it could never answer heartbeats and
+# the broker would drop it after an idle spell; heartbeats stay off there instead.
+CONSUMER_HEARTBEAT = 30
+PUBLISHER_HEARTBEAT = 0
+
+@functools.lru_cache(maxsize=None)
+def _params(rabbitmq_url: str, heartbeat: int) -> pika.URLParameters:
+    """Parse the AMQP URL once per process and connection role."""
+    params = pika.URLParameters(rabbitmq_url)
+    params.heartbeat = heartbeat
+    params.blocked_connection_timeout = 300
+    return params
+
+# Shared publisher connection/channel, reused across publishes. BlockingConnection
+# is not thread-safe, so every access goes through _pub_lock.
+_pub_conn = None
+_pub_channel = None
+_pub_lock = threading.Lock()
+
+def _reset_publisher():
+    global _pub_conn, _pub_channel
     try:
-        params = pika.URLParameters(rabbitmq_url)
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True)
-        body = json.dumps(event)
-        channel.basic_publish(exchange=EXCHANGE, routing_key=routing_key, body=body)
-        connection.close()
-    except Exception as e:
-        print("Error publishing event:", e)
-        traceback.print_exc()
+        if _pub_conn is not None and _pub_conn.is_open:
+            _pub_conn.close()
+    except Exception:
+        pass
+    _pub_conn = None
+    _pub_channel = None
+
+def _get_publisher(rabbitmq_url: str):
+    """
+    Return the shared publisher channel, connecting lazily on first use or after the
+    previous connection dropped. Must be called with _pub_lock held.
+    """
+    global _pub_conn, _pub_channel
+    if _pub_conn is None or not _pub_conn.is_open or _pub_channel is None or not _pub_channel.is_open:
+        _reset_publisher()
+        _pub_conn = pika.BlockingConnection(_params(rabbitmq_url, PUBLISHER_HEARTBEAT))
+        _pub_channel = _pub_conn.channel()
+        _pub_channel.confirm_delivery()
+        _pub_channel.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True, passive=False)
+    return _pub_channel
+
+def close_publisher():
+    with _pub_lock:
+        _reset_publisher()
+
+def publish_event(rabbitmq_url: str, routing_key: str, event: dict, mandatory: bool = False) -> bool:
+    """
+    Publish a persistent (delivery_mode=2) event and wait for the broker's confirm.
+    Returns True once the broker has confirmed it. With mandatory=True a message no
+    queue is bound for is returned by the broker and counts as a failed publish.
+    """
+    body = orjson.dumps(event)
+    with _pub_lock:
+        for attempt in range(2):
+            try:
+                channel = _get_publisher(rabbitmq_url)
+                channel.basic_publish(exchange=EXCHANGE, routing_key=routing_key, body=body,
+                                      properties=_PERSISTENT, mandatory=mandatory)
+                return True
+            except pika.exceptions.UnroutableError as e:
+                # the channel is fine, there is just no queue for this key yet; retrying won't help
+                print("Event was not routed to any queue:", routing_key, e)
+                return False
+            except pika.exceptions.AMQPError as e:
+                # stale/broken connection or nacked publish: drop it and retry once on a fresh one
+                _reset_publisher()
+                if attempt:
+                    print("Error publishing event:", e)
+                    traceback.print_exc()
+            except Exception as e:
+                print("Error publishing event:", e)
+                traceback.print_exc()
+                return False
+    return False
 
 def process_payment_and_publish(rabbitmq_url: str, payment_id: int, student_id: str, enrollment_id: int, amount: float):
     """
     Simulate contacting a payment gateway and publish PaymentConfirmed/Failed.
-    Even amounts succeed in this demo; odd amounts fail.
+    Even amounts succeed in this demo; odd amounts fail. SIM_GATEWAY_LATENCY adds an
+    artificial gateway delay for local testing.
+    The payment is claimed (PENDING -> PROCESSING) before the gateway call, so when the
+    same payment is submitted by several pods or twice on one, only one call goes out.
     """
     try:
-        time.sleep(1)
-        success = int(amount) % 2 == 0
+        if database.SessionLocal is None:
+            raise RuntimeError("Database is not initialized; init_db() must run at startup")
 
-        database.init_db(os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/payment_db"))
         db = database.SessionLocal()
         try:
-            payment = db.query(models.Payment).filter(models.Payment.id == payment_id).first()
+            # the claim time doubles as a token: only the latest claimant may finish the payment
+            claimed_at = datetime.now(timezone.utc)
+            claimed = db.execute(
+                update(models.Payment)
+                .where(models.Payment.id == payment_id, _claimable(claimed_at))
+                .values(status="PROCESSING", updated_at=claimed_at)
+                .returning(models.Payment.id)
+            ).scalar_one_or_none()
+            db.commit()
+            if claimed is None:
+                print("Payment not found, already claimed or no longer PENDING in process_payment_and_publish:", payment_id)
+                return
+
+            if SIM_GATEWAY_LATENCY:
+                time.sleep(SIM_GATEWAY_LATENCY)
+            success = int(amount) % 2 == 0
+
+            # conditional UPDATE: only our own claim transitions, so a payment taken over
+            # after a stale claim is never confirmed twice
+            values = {"status": "SUCCESS", "transaction_ref": f"tx-{payment_id}-{int(time.time())}"} if success else {"status": "FAILED"}
+            payment = db.execute(
+                update(models.Payment)
+                .where(models.Payment.id == payment_id, models.Payment.status == "PROCESSING",
+                       models.Payment.updated_at == claimed_at)
+                .values(**values)
+                .returning(models.Payment)
+            ).scalar_one_or_none()
+            db.commit()
             if not payment:
-                print("Payment not found in process_payment_and_publish:", payment_id)
+                print("Payment claim was taken over before the gateway result was saved:", payment_id)
                 return
 
             if success:
-                payment.status = "SUCCESS"
-                payment.transaction_ref = f"tx-{payment_id}-{int(time.time())}"
-                db.commit()
-                db.refresh(payment)
                 event = {"type": "PaymentConfirmed", "payload": {"payment_id": payment.id, "enrollment_id": enrollment_id, "student_id": student_id}}
                 publish_event(rabbitmq_url, "payment.events.confirmed", event)
                 print(f"Payment {payment_id} SUCCESS, published PaymentConfirmed.")
             else:
-                payment.status = "FAILED"
-                db.commit()
-                db.refresh(payment)
                 event = {"type": "PaymentFailed", "payload": {"payment_id": payment.id, "enrollment_id": enrollment_id, "student_id": student_id}}
                 publish_event(rabbitmq_url, "payment.events.failed", event)
                 print(f"Payment {payment_id} FAILED, published PaymentFailed.")
@@ -60,23 +172,102 @@ def process_payment_and_publish(rabbitmq_url: str, payment_id: int, student_id:
         print("Error in process_payment_and_publish:", e)
         traceback.print_exc()
 
-def _process_registration_event(body: dict, db: Session):
+# Payments are handed to a dedicated pool so slow gateway calls never occupy the
+# request-handling threadpool.
+_gateway_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PAYMENT_WORKERS", "8")), thread_name_prefix="payment-gateway")
+
+def submit_payment(rabbitmq_url: str, payment_id: int, student_id: str, enrollment_id: int, amount: float):
+    _gateway_pool.submit(process_payment_and_publish, rabbitmq_url, payment_id, student_id, enrollment_id, amount)
+
+def shutdown_payments():
+    # let submitted payments finish; anything lost anyway is picked up by resume_pending_payments()
+    _gateway_pool.shutdown(wait=True)
+
+def _registration_row(body: dict) -> dict:
     """
     Called when Enrollment publishes RegistrationPendingPayment.
-    Creates a PENDING payment record and DOES NOT auto-process it.
-    Admin must call /payments/{id}/approve to confirm.
+    Builds the PENDING payment row for the event; rows are inserted in batches by the
+    consumer and are NOT auto-processed. Admin must call /payments/{id}/approve to confirm.
+    Raises ValueError if a required field is missing.
     """
-    payload = body.get("payload", {})
-    enrollment_id = payload.get("enrollment_id")
-    student_id = payload.get("student_id")
-    amount = payload.get("amount", 0.0)
+    payload = body.get("payload") or {}
+    row = {
+        "student_id": payload.get("student_id"),
+        "enrollment_id": payload.get("enrollment_id"),
+        "amount": payload.get("amount", 0.0),
+        "status": "PENDING",
+        "idempotency_key": None,
+    }
+    missing = [name for name in ("student_id", "enrollment_id", "amount") if row[name] is None]
+    if missing:
+        raise ValueError(f"payment event is missing {', '.join(missing)}")
+    return row
 
-    payment = models.Payment(student_id=student_id, enrollment_id=enrollment_id, amount=amount, status="PENDING")
-    db.add(payment)
+def _payment_request_row(body: dict) -> dict:
+    """
+    Called for PaymentRequested commands published by POST /payments.
+    Builds the PENDING payment row; once inserted it is sent to the gateway.
+    """
+    row = _registration_row(body)
+    row["idempotency_key"] = body.get("payload", {}).get("idempotency_key")
+    if row["idempotency_key"] is None:
+        raise ValueError("payment request is missing idempotency_key")
+    return row
+
+def _insert_payments(rows: list, db: Session) -> list:
+    """
+    Insert a batch of PENDING payments and commit. Rows whose idempotency_key already
+    exists (a redelivered PaymentRequested) are skipped; returns the rows actually inserted.
+    """
+    stmt = (
+        pg_insert(models.Payment)
+        .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        .returning(models.Payment.id, models.Payment.student_id, models.Payment.enrollment_id,
+                   models.Payment.amount, models.Payment.idempotency_key)
+    )
+    inserted = db.execute(stmt, rows).all()
     db.commit()
-    db.refresh(payment)
+    for row in inserted:
+        print(f"Created PENDING payment id={row.id} for enrollment={row.enrollment_id} student={row.student_id}")
+    return inserted
 
-    print(f"Created PENDING payment id={payment.id} for enrollment={enrollment_id} student={student_id}")
+
+def _claimable(now: datetime):
+    """PENDING payments, or PROCESSING ones whose claim is older than PAYMENT_CLAIM_TIMEOUT."""
+    stale = now - timedelta(seconds=PAYMENT_CLAIM_TIMEOUT)
+    return or_(models.Payment.status == "PENDING",
+               and_(models.Payment.status == "PROCESSING", models.Payment.updated_at < stale))
+
+def _pending_requests(db: Session, keys=None) -> list:
+    """
+    Payments created through POST /payments (i.e. with an idempotency key) that still
+    need the gateway, optionally limited to the given keys. These are only candidates:
+    several pods may return the same row, and process_payment_and_publish claims each
+    one before calling the gateway, so only one of them goes through.
+    """
+    stmt = select(models.Payment.id, models.Payment.student_id, models.Payment.enrollment_id, models.Payment.amount).where(
+        _claimable(datetime.now(timezone.utc)), models.Payment.idempotency_key.is_not(None))
+    if keys is not None:
+        stmt = stmt.where(models.Payment.idempotency_key.in_(keys))
+    rows = db.execute(stmt).all()
+    db.commit()
+    return rows
+
+def resume_pending_payments(rabbitmq_url: str):
+    """
+    Re-submit requested payments not yet sent to the gateway (or whose claim went stale),
+    e.g. because the process stopped after committing them but before the gateway task
+    finished. Called once at startup by every pod; the claim keeps it to one gateway call.
+    """
+    db = database.SessionLocal()
+    try:
+        rows = _pending_requests(db)
+    finally:
+        db.close()
+    for payment in rows:
+        submit_payment(rabbitmq_url, payment.id, payment.student_id, payment.enrollment_id, payment.amount)
+    if rows:
+        print(f"Resubmitted {len(rows)} PENDING payment request(s) to the gateway")
 
 
 def _consumer_runloop(database_url: str, rabbitmq_url: str, queue_name: str = ""):
@@ -84,49 +275,118 @@ def _consumer_runloop(database_url: str, rabbitmq_url: str, queue_name: str = ""
     Persistent consumer loop: connects, declares exchange & queue, binds and consumes.
     Reconnects on errors with backoff.
     """
+    global _consumer_conn, _consumer_channel
     database.init_db(database_url)
 
-    while True:
+    delay = 1.0
+    while not _consumer_stop.is_set():
         conn = None
+        db = None
         try:
-            params = pika.URLParameters(rabbitmq_url)
-            conn = pika.BlockingConnection(params)
+            conn = pika.BlockingConnection(_params(rabbitmq_url, CONSUMER_HEARTBEAT))
             ch = conn.channel()
             ch.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True)
 
             if queue_name:
-                q = ch.queue_declare(queue=queue_name, durable=False, exclusive=False)
+                # durable, so queued payment commands survive a broker restart
+                q = ch.queue_declare(queue=queue_name, durable=True, exclusive=False)
                 actual_queue = queue_name
             else:
                 q = ch.queue_declare(queue="", exclusive=True)
                 actual_queue = q.method.queue
 
             ch.queue_bind(exchange=EXCHANGE, queue=actual_queue, routing_key="enrollment.events.#")
-            print(f"Payment consumer bound queue={actual_queue} to {EXCHANGE} with key=enrollment.events.#")
+            ch.queue_bind(exchange=EXCHANGE, queue=actual_queue, routing_key=PAYMENT_REQUEST_KEY)
+            print(f"Payment consumer bound queue={actual_queue} to {EXCHANGE} with keys=enrollment.events.#, {PAYMENT_REQUEST_KEY}")
+
+            # (delivery_tag, row) for every delivery received since the last flush
+            pending = []
+            # one session for the life of this connection; every batch ends in commit or rollback,
+            # which hands its DB connection back to the pool (pre-pinged on the next checkout)
+            db = database.SessionLocal()
+
+            def flush():
+                # one INSERT + COMMIT for the batch, then one ack frame for all its deliveries
+                nonlocal delay
+                if not pending:
+                    return
+                # highest tag to ack once the batch is committed; rejected rows are excluded,
+                # since acking a tag that was already nacked closes the channel
+                ack_tag = pending[-1][0]
+                try:
+                    _insert_payments([row for _, row in pending], db)
+                except (IntegrityError, DataError) as exc:
+                    # a row the database rejects would fail the same way on every redelivery,
+                    # so insert one at a time and reject only the offending messages
+                    print("Payment batch rejected, retrying rows individually:", exc)
+                    db.rollback()
+                    ack_tag = None
+                    for tag, row in pending:
+                        try:
+                            _insert_payments([row], db)
+                            ack_tag = tag
+                        except (IntegrityError, DataError) as row_exc:
+                            db.rollback()
+                            print(f"Rejecting message {tag}:", row_exc)
+                            ch.basic_nack(delivery_tag=tag, requeue=False)
+                except Exception:
+                    # e.g. database unavailable: leave the batch unacked and let the reconnect
+                    # loop back off; the broker redelivers it once the connection closes
+                    db.rollback()
+                    raise
+                # requested payments go to the gateway once committed, before the ack. A redelivered
+                # request is skipped by the insert, but if its row is still unclaimed (or its claim
+                # went stale) it is resubmitted: the gateway task may have been lost with a previous process.
+                keys = [row["idempotency_key"] for _, row in pending if row["idempotency_key"] is not None]
+                if keys:
+                    for payment in _pending_requests(db, keys):
+                        submit_payment(rabbitmq_url, payment.id, payment.student_id, payment.enrollment_id, payment.amount)
+                # multiple=True settles every still-unacked tag up to ack_tag; earlier
+                # rejected tags are already settled and are not affected
+                if ack_tag is not None:
+                    ch.basic_ack(delivery_tag=ack_tag, multiple=True)
+                    print(f"Acked message(s) up to tag {ack_tag}")
+                pending.clear()
+                # broker and database both worked end to end: the next outage starts backing
+                # off from the minimum again
+                delay = 1.0
+
+            def flush_timer():
+                flush()
+                conn.call_later(ACK_FLUSH_INTERVAL, flush_timer)
 
             def callback(ch, method, properties, body):
                 try:
-                    payload = json.loads(body)
+                    payload = orjson.loads(body)
                     print("Payment consumer received message:", payload)
-                    db = database.SessionLocal()
-                    try:
-                        _process_registration_event(payload, db)
-                    finally:
-                        db.close()
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    print("Message processed and acked:", method.delivery_tag)
+                    if method.routing_key == PAYMENT_REQUEST_KEY:
+                        row = _payment_request_row(payload)
+                    else:
+                        row = _registration_row(payload)
                 except Exception as exc:
+                    # malformed or incomplete events are rejected on their own, never batched
                     print("Error processing message:", exc)
                     traceback.print_exc()
                     try:
                         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
                     except Exception:
                         pass
+                    return
+                pending.append((method.delivery_tag, row))
+                if len(pending) >= PAYMENT_ACK_BATCH:
+                    flush()
 
-            ch.basic_qos(prefetch_count=1)
+            # qos is per channel, so it is re-applied on every reconnect
+            ch.basic_qos(prefetch_count=PAYMENT_PREFETCH, global_qos=False)
             ch.basic_consume(queue=actual_queue, on_message_callback=callback, auto_ack=False)
+            conn.call_later(ACK_FLUSH_INTERVAL, flush_timer)
+            _consumer_conn, _consumer_channel = conn, ch
+            if _consumer_stop.is_set():
+                break
             print("Payment consumer starting to consume on queue:", actual_queue)
             ch.start_consuming()
+            # returns only after stop_consumer(); settle what was already received
+            flush()
 
         except pika.exceptions.AMQPConnectionError as e:
             print("AMQP connection error in consumer:", e)
@@ -134,18 +394,43 @@ def _consumer_runloop(database_url: str, rabbitmq_url: str, queue_name: str = ""
             print("Unexpected exception in consumer loop:", e)
             traceback.print_exc()
         finally:
+            _consumer_conn, _consumer_channel = None, None
+            if db is not None:
+                db.close()
             try:
                 if conn and conn.is_open:
                     conn.close()
             except Exception:
                 pass
 
-        print("Payment consumer will reconnect after backoff...")
-        time.sleep(3)
+        if _consumer_stop.is_set():
+            break
+        # exponential backoff with jitter so a fleet of instances doesn't reconnect in lockstep
+        wait = delay + random.uniform(0, delay / 2)
+        print(f"Payment consumer will reconnect after {wait:.1f}s backoff...")
+        _consumer_stop.wait(wait)
+        delay = min(delay * 2, MAX_RECONNECT_INTERVAL)
+    print("Payment consumer stopped.")
 
 _consumer = None
+_consumer_stop = threading.Event()
+_consumer_conn = None
+_consumer_channel = None
 def start_consumer(database_url: str, rabbitmq_url: str, queue_name: str = ""):
     global _consumer
     if _consumer is None:
         _consumer = threading.Thread(target=_consumer_runloop, args=(database_url, rabbitmq_url, queue_name), daemon=True)
-        _consumer.start()
\ No newline at end of file
+        _consumer.start()
+
+def stop_consumer(timeout: float = 5.0):
+    """Stop consuming, flush pending acks and wait for the consumer thread to exit."""
+    _consumer_stop.set()
+    conn, ch = _consumer_conn, _consumer_channel
+    try:
+        if conn is not None and conn.is_open:
+            # BlockingConnection is owned by the consumer thread; hand the stop over to it
+            conn.add_callback_threadsafe(ch.stop_consuming)
+    except Exception as e:
+        print("Error stopping consumer:", e)
+    if _consumer is not None:
+        _consumer.join(timeout)
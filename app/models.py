@@ -1,13 +1,20 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, func
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index, func
 from app.database import Base
 
 class Payment(Base):
     __tablename__ = "payments"
+    # match list_payments: filter by status/student_id, newest first (id breaks ties)
+    __table_args__ = (
+        Index("ix_payments_status_created", "status", "created_at", "id"),
+        Index("ix_payments_student_created", "student_id", "created_at", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(String(64), nullable=False, index=True)
     enrollment_id = Column(Integer, index=True, nullable=False)
     amount = Column(Float, nullable=False)
     status = Column(String(20), nullable=False, default="PENDING")
     transaction_ref = Column(String(128), nullable=True)
+    # dedupes PaymentRequested commands redelivered by the broker (at-least-once)
+    idempotency_key = Column(String(64), nullable=True, unique=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
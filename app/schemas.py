@@ -10,10 +10,12 @@ class PaymentCreate(BaseModel):
 class PaymentOut(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
-    id: int
+    # None until the consumer has persisted an accepted payment
+    id: Optional[int] = None
     student_id: str
     enrollment_id: int
     amount: float
     status: str
     transaction_ref: Optional[str] = None
+    idempotency_key: Optional[str] = None
     created_at: Optional[datetime] = None
\ No newline at end of file
@@ -0,0 +1,9 @@
+-- Composite indexes backing GET /payments (filter by status or student_id, newest first,
+-- id as the tie-breaker for rows sharing a created_at).
+-- New databases already get these from create_all at startup; run this once against
+-- existing databases. CONCURRENTLY cannot run inside a transaction, so apply it with
+-- plain psql (no --single-transaction):
+--   psql "$DATABASE_URL" -f migrations/001_add_list_payments_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_status_created ON payments (status, created_at, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_student_created ON payments (student_id, created_at, id);
@@ -0,0 +1,9 @@
+-- Idempotency key for payments accepted by POST /payments; the consumer's
+-- INSERT ... ON CONFLICT (idempotency_key) relies on the unique index.
+-- Run once against existing databases, before deploying the image that publishes
+-- PaymentRequested. CONCURRENTLY cannot run inside a transaction, so apply it with
+-- plain psql (no --single-transaction):
+--   psql "$DATABASE_URL" -f migrations/002_add_payment_idempotency_key.sql
+
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_idempotency_key ON payments (idempotency_key);